@@ -1,25 +1,67 @@
 # app/__init__.py
 from __future__ import annotations
-from flask import Flask, jsonify
+from flask import Flask, jsonify, request, g
 from flask_cors import CORS
 import os
+import time
 
 def create_app() -> Flask:
     app = Flask(__name__)
     # Optional: limit upload size (set via env, default 50 MB)
-    app.config["MAX_CONTENT_LENGTH"] = int(os.getenv("MAX_CONTENT_LENGTH", 50 * 1024 * 1024))
+    app.config["MAX_CONTENT_LENGTH"] = int(os.getenv("MAX_CONTENT_LENGTH") or 50 * 1024 * 1024)
     # CORS (adjust origins as needed)
-    CORS(app, resources={r"/api/*": {"origins": "*"}}, expose_headers=["X-PSNR-dB", "X-Ext"])
+    CORS(app, resources={r"/api/*": {"origins": "*"}},
+         expose_headers=["X-PSNR-dB", "X-Ext", "Location", "Retry-After", "Server-Timing", "X-Profile-Id"])
+
+    # Big uploads spool to files that workers map; removed after the response
+    from .services import spool
+    spool.init_app(app)
 
     # Register blueprints
     from .routes.api_bp import api_bp
     app.register_blueprint(api_bp, url_prefix="/api")
 
+    # Request metrics (in-flight, latency by route); /api/metrics itself is not counted
+    from .services.metrics import metrics
+
+    def _route() -> str:
+        return request.url_rule.rule if request.url_rule is not None else "unmatched"
+
+    def _tracked() -> bool:
+        return request.path.startswith("/api/") and request.endpoint != "api.prometheus_metrics"
+
+    @app.before_request
+    def _request_started():
+        g.request_started = time.perf_counter()
+        if _tracked():
+            g.metrics_route = _route()
+            metrics.request_started(g.metrics_route)
+
+    @app.after_request
+    def _request_done(resp):
+        if "metrics_route" in g:
+            metrics.observe_request(g.metrics_route, request.method, resp.status_code,
+                                    time.perf_counter() - g.request_started)
+        if "Server-Timing" in resp.headers:
+            resp.headers["Timing-Allow-Origin"] = "*"
+        return resp
+
+    @app.teardown_request
+    def _request_finished(_exc):
+        if "metrics_route" in g:
+            metrics.request_finished(g.metrics_route)
+
     # JSON error handler
     @app.errorhandler(Exception)
     def _on_error(e):
         # Keep simple; customize per error type if you like
         status = getattr(e, "code", 500)
-        return jsonify({"ok": False, "error": str(e)}), status
+        body = {"ok": False, "error": str(e)}
+        headers = {}
+        if getattr(e, "job_id", None):  # sync call timed out: the job can still be polled
+            body["job_id"] = e.job_id
+        if getattr(e, "retry_after", None):  # job queue full
+            headers["Retry-After"] = str(e.retry_after)
+        return jsonify(body), status, headers
 
     return app
@@ -1,35 +1,28 @@
 # app/routes/api_bp.py
 from __future__ import annotations
-from flask import Blueprint, request, abort, send_file, Response
+from flask import Blueprint, request, abort, send_file, make_response, g, Response
 from werkzeug.utils import secure_filename
+from typing import Any, Dict, Optional, Tuple, Union
 import io
+import os
+import time
 
 from ..services.steg_service import (
-    embed_stego,
-    extract_payload,
     _parse_bpf,
     _parse_bool,
-    estimate_capacity_bytes,
 )
+from ..services import spool
+from ..services.jobs import Job, jobs
+from ..services.metrics import metrics, server_timing
 
 api_bp = Blueprint("api", __name__)
 
-@api_bp.get("/health")
-def health():
-    return {"ok": True, "service": "mp3lsbsteg-backend"}
+# How long the synchronous endpoints wait for their job (seconds)
+SYNC_TIMEOUT = float(os.getenv("SYNC_TIMEOUT") or 120)
 
-@api_bp.post("/embed")
-def embed():
-    """
-    Multipart form-data:
-      - carrier: MP3 file (required)
-      - payload: file to hide (required)
-      - bits_per_frame: int [1..4] (optional, default 4)
-      - key: string (optional)
-      - vigenere: bool (optional, default false)
+# ---------- request parsing: (kwargs for the op, input size, extras for the response) ----------
 
-    Returns: stego MP3 stream (audio/mpeg) with X-PSNR-dB header.
-    """
+def _embed_request() -> Tuple[Dict[str, Any], int, Dict[str, Any]]:
     if "carrier" not in request.files or "payload" not in request.files:
         abort(400, "carrier and payload files are required")
 
@@ -39,48 +32,26 @@ def embed():
     bits_per_frame = _parse_bpf(request.form.get("bits_per_frame"), default=4)
     vigenere = _parse_bool(request.form.get("vigenere"), default=False)
 
-    carrier_bytes = carrier_file.read()
-    payload_bytes = payload_file.read()
+    carrier, carrier_size = spool.source(carrier_file)
+    payload, _payload_size = spool.source(payload_file)
 
     # Use the original filename for header extension; secure it for safety.
     payload_name = secure_filename(payload_file.filename or "p.bin") or "p.bin"
 
-    stego_bytes, psnr_db = embed_stego(
-        carrier_bytes=carrier_bytes,
-        payload_bytes=payload_bytes,
+    kwargs = dict(
+        carrier=carrier,
+        payload=payload,
         payload_filename=payload_name,
         bits_per_frame=bits_per_frame,
         key=key,
         vigenere=vigenere,
     )
+    if isinstance(carrier, str):
+        # a spooled carrier is patched on disk: the stego MP3 goes to a file, not back through the pool
+        kwargs["out_path"] = spool.new_file("stego-", ".mp3")
+    return kwargs, carrier_size, {"bits_per_frame": bits_per_frame}
 
-    bio = io.BytesIO(stego_bytes)
-    bio.seek(0)
-    resp = send_file(
-        bio,
-        mimetype="audio/mpeg",
-        as_attachment=True,
-        download_name="stego.mp3",
-        max_age=0,
-        conditional=False,
-        etag=False,
-        last_modified=None,
-    )
-    resp.headers["X-PSNR-dB"] = f"{psnr_db:.2f}"
-    resp.headers["X-Bits-Per-Frame"] = str(bits_per_frame)
-    return resp
-
-@api_bp.post("/extract")
-def extract():
-    """
-    Multipart form-data:
-      - stego: MP3 file with embedded payload (required)
-      - bits_per_frame: int [1..4] (optional, default 4; MUST match embed)
-      - key: string (optional; MUST match embed)
-      - vigenere: bool (optional; MUST match embed)
-
-    Returns: recovered payload stream (application/octet-stream).
-    """
+def _extract_request() -> Tuple[Dict[str, Any], int, Dict[str, Any]]:
     if "stego" not in request.files:
         abort(400, "stego file is required")
 
@@ -89,31 +60,159 @@ def extract():
     bits_per_frame = _parse_bpf(request.form.get("bits_per_frame"), default=4)
     vigenere = _parse_bool(request.form.get("vigenere"), default=False)
 
-    stego_bytes = stego_file.read()
+    stego, stego_size = spool.source(stego_file)
 
-    data, ext = extract_payload(
-        stego_bytes=stego_bytes,
+    kwargs = dict(
+        stego=stego,
         bits_per_frame=bits_per_frame,
         key=key,
         vigenere=vigenere,
     )
+    return kwargs, stego_size, {}
 
-    filename = f"recovered.{ext}" if ext else "recovered.bin"
-    bio = io.BytesIO(data)
-    bio.seek(0)
+def _capacity_request() -> Tuple[Dict[str, Any], int, Dict[str, Any]]:
+    if "carrier" not in request.files:
+        abort(400, "carrier file is required")
+
+    carrier_file = request.files["carrier"]
+    carrier, carrier_size = spool.source(carrier_file)
+
+    bits_per_frame = _parse_bpf(request.form.get("bits_per_frame"), default=4)
+    key = request.form.get("key") or None
+    payload_size = request.form.get("payload_size")
+    vigenere = _parse_bool(request.form.get("vigenere"), default=False)  # for UI parity only
+
+    try:
+        payload_size_int = int(payload_size) if payload_size is not None else None
+    except ValueError:
+        abort(400, "payload_size must be an integer")
+
+    kwargs = dict(
+        carrier=carrier,
+        bits_per_frame=bits_per_frame,
+        key=key,
+    )
+    extras = {"bits_per_frame": bits_per_frame, "vigenere": vigenere, "payload_size": payload_size_int}
+    return kwargs, carrier_size, extras
+
+# ---------- responses from an op's result ----------
+
+def _file_response(data: Union[bytes, str], *, mimetype: str, download_name: str) -> Response:
+    """
+    Stream bytes, or a spooled result file by path, as an attachment with
+    Content-Length. A file goes out in chunks (sendfile where the server has it).
+    """
+    if isinstance(data, str):
+        fh = spool.open_result(data)
+        size = os.fstat(fh.fileno()).st_size
+    else:
+        fh, size = io.BytesIO(data), len(data)
     resp = send_file(
-        bio,
-        mimetype="application/octet-stream",
+        fh,
+        mimetype=mimetype,
         as_attachment=True,
-        download_name=filename,
+        download_name=download_name,
         max_age=0,
         conditional=False,
         etag=False,
         last_modified=None,
     )
+    resp.content_length = size
+    return resp
+
+def _embed_response(result, extras: Dict[str, Any]) -> Response:
+    stego, psnr_db = result
+    resp = _file_response(stego, mimetype="audio/mpeg", download_name="stego.mp3")
+    resp.headers["X-PSNR-dB"] = f"{psnr_db:.2f}"
+    resp.headers["X-Bits-Per-Frame"] = str(extras["bits_per_frame"])
+    return resp
+
+def _extract_response(result, extras: Dict[str, Any]) -> Response:
+    data, ext = result
+    filename = f"recovered.{ext}" if ext else "recovered.bin"
+    resp = _file_response(data, mimetype="application/octet-stream", download_name=filename)
     resp.headers["X-Ext"] = ext or ""
     return resp
 
+def _capacity_response(metrics, extras: Dict[str, Any]):
+    resp = {
+        "ok": True,
+        "bits_per_frame": extras["bits_per_frame"],
+        "vigenere": bool(extras["vigenere"]),  # informational; capacity is unaffected
+        **metrics,
+    }
+    payload_size_int = extras["payload_size"]
+    if payload_size_int is not None:
+        resp["payload_size"] = payload_size_int
+        resp["fits"] = payload_size_int + metrics["header_size_bytes"] <= metrics["capacity_bytes"]
+    return resp
+
+_OPS = {
+    "embed": (_embed_request, _embed_response),
+    "extract": (_extract_request, _extract_response),
+    "capacity": (_capacity_request, _capacity_response),
+}
+
+def _with_timing(resp, job: Job, total_seconds: Optional[float] = None) -> Response:
+    """
+    Attach the job's stage timings (Server-Timing) and, for a sampled job, its
+    profile id. `total` defaults to the time spent on this request so far.
+    """
+    resp = make_response(resp)
+    if total_seconds is None and "request_started" in g:
+        total_seconds = time.perf_counter() - g.request_started
+    resp.headers["Server-Timing"] = server_timing(
+        job.timings, queue_seconds=job.queue_seconds, total_seconds=total_seconds,
+    )
+    if job.profile is not None:
+        resp.headers["X-Profile-Id"] = job.id
+    return resp
+
+def _run_sync(op: str):
+    parse, respond = _OPS[op]
+    kwargs, size, extras = parse()
+    result, job = jobs.run(op, kwargs, size=size, timeout=SYNC_TIMEOUT, files=spool.detach())
+    spool.attach(job.files)  # delivered: back to the request, removed at teardown
+    return _with_timing(respond(result, extras), job)
+
+# ---------- synchronous endpoints ----------
+
+@api_bp.get("/health")
+def health():
+    return {"ok": True, "service": "mp3lsbsteg-backend"}
+
+@api_bp.get("/metrics")
+def prometheus_metrics():
+    """Prometheus text format: request and stage latency histograms, throughput, cache hit rates."""
+    return Response(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+@api_bp.post("/embed")
+def embed():
+    """
+    Multipart form-data:
+      - carrier: MP3 file (required)
+      - payload: file to hide (required)
+      - bits_per_frame: int [1..4] (optional, default 4)
+      - key: string (optional)
+      - vigenere: bool (optional, default false)
+
+    Returns: stego MP3 stream (audio/mpeg) with X-PSNR-dB header.
+    """
+    return _run_sync("embed")
+
+@api_bp.post("/extract")
+def extract():
+    """
+    Multipart form-data:
+      - stego: MP3 file with embedded payload (required)
+      - bits_per_frame: int [1..4] (optional, default 4; MUST match embed)
+      - key: string (optional; MUST match embed)
+      - vigenere: bool (optional; MUST match embed)
+
+    Returns: recovered payload stream (application/octet-stream).
+    """
+    return _run_sync("extract")
+
 @api_bp.post("/capacity")
 def capacity():
     """
@@ -121,36 +220,58 @@ def capacity():
       - carrier: MP3 file (required)
       - bits_per_frame: int [1..4] (optional, default 4)
       - payload_size: int (optional) – if provided, response includes `fits`
+      - key: string (optional) – same key as the upcoming embed, so its plan is reused
       - vigenere: bool (optional) – echoed back, does not change capacity
 
     Returns JSON with capacity metrics.
     """
-    if "carrier" not in request.files:
-        abort(400, "carrier file is required")
+    return _run_sync("capacity")
 
-    carrier_file = request.files["carrier"]
-    carrier_bytes = carrier_file.read()
+# ---------- background jobs ----------
 
-    bits_per_frame = _parse_bpf(request.form.get("bits_per_frame"), default=4)
-    payload_size = request.form.get("payload_size")
-    vigenere = _parse_bool(request.form.get("vigenere"), default=False)  # for UI parity only
+@api_bp.post("/jobs")
+def submit_job():
+    """
+    Multipart form-data:
+      - op: "embed" | "extract" | "capacity" (required)
+      - the fields of the matching synchronous endpoint
 
-    try:
-        payload_size_int = int(payload_size) if payload_size is not None else None
-    except ValueError:
-        abort(400, "payload_size must be an integer")
+    Returns 202 with the job id; 503 (Retry-After) when the queue is full.
+    """
+    op = request.form.get("op")
+    if op not in _OPS:
+        abort(400, "op must be one of: " + ", ".join(_OPS))
+    parse, _respond = _OPS[op]
+    kwargs, size, extras = parse()
+    job = jobs.submit(op, kwargs, size=size, meta=extras, files=spool.detach())
+    return {"ok": True, **job.status()}, 202, {"Location": f"/api/jobs/{job.id}"}
 
-    metrics = estimate_capacity_bytes(
-        carrier_bytes=carrier_bytes,
-        bits_per_frame=bits_per_frame,
-    )
-    resp = {
-        "ok": True,
-        "bits_per_frame": bits_per_frame,
-        "vigenere": bool(vigenere),  # informational; capacity is unaffected
-        **metrics,
-    }
-    if payload_size_int is not None:
-        resp["payload_size"] = payload_size_int
-        resp["fits"] = payload_size_int + metrics["header_size_bytes"] <= metrics["capacity_bytes"]
-    return resp
\ No newline at end of file
+@api_bp.get("/jobs/<job_id>")
+def job_status(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        abort(404, "unknown or expired job")
+    return {"ok": True, **job.status()}
+
+@api_bp.get("/jobs/<job_id>/result")
+def job_result(job_id: str):
+    """The op's response, as the synchronous endpoint would return it; 409 while not finished."""
+    job = jobs.get(job_id)
+    if job is None:
+        abort(404, "unknown or expired job")
+    state = job.state
+    if state in ("queued", "running", "cancelled"):
+        return {"ok": False, "error": f"job is {state}", **job.status()}, 409
+    _parse, respond = _OPS[job.op]
+    result = jobs.result(job)
+    return _with_timing(respond(result, job.meta), job, total_seconds=job.finished_at - job.submitted_at)
+
+@api_bp.delete("/jobs/<job_id>")
+def cancel_job(job_id: str):
+    """Cancel a queued job or discard a finished one; 409 if it is already running."""
+    cancelled = jobs.cancel(job_id)
+    if cancelled is None:
+        abort(404, "unknown or expired job")
+    if not cancelled:
+        return {"ok": False, "error": "job is already running"}, 409
+    return {"ok": True, "job_id": job_id}
@@ -0,0 +1,330 @@
+# app/services/jobs.py
+from __future__ import annotations
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+import atexit
+import cProfile
+import io
+import multiprocessing
+import os
+import pstats
+import random
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+
+from mp3lsbsteg import api
+
+from . import spool
+from .metrics import metrics
+from .steg_service import embed_stego, extract_payload, estimate_capacity_bytes, share_caches
+
+# Worker processes for big inputs (default: one per core)
+JOB_WORKERS = int(os.getenv("JOB_WORKERS") or os.cpu_count() or 1)
+# Worker processes reserved for small inputs, so they never wait behind a big embed
+JOB_FAST_WORKERS = int(os.getenv("JOB_FAST_WORKERS") or 1)
+# Inputs up to this size (bytes) go to the fast lane, default 2 MB
+JOB_FAST_BYTES = int(os.getenv("JOB_FAST_BYTES") or 2 * 1024 * 1024)
+# Admission control: unfinished jobs per lane before new ones are refused
+JOB_QUEUE_LIMIT = int(os.getenv("JOB_QUEUE_LIMIT") or 4 * max(JOB_WORKERS, 1))
+# Finished jobs are kept this long (seconds) for /api/jobs/<id>/result
+JOB_RESULT_TTL = float(os.getenv("JOB_RESULT_TTL") or 600)
+# Fraction of jobs run under the profilers (0 disables), e.g. 0.01
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE") or 0)
+# Profilers for sampled jobs: cprofile and/or tracemalloc
+PROFILE_TOOLS = frozenset(t.strip() for t in (os.getenv("PROFILE_TOOLS") or "cprofile,tracemalloc").split(",") if t.strip())
+# Where sampled jobs leave <job_id>.prof (pstats) and <job_id>.txt (summary)
+PROFILE_DIR = os.getenv("PROFILE_DIR") or os.path.join(tempfile.gettempdir(), "mp3lsbsteg-profiles")
+
+OPS: Dict[str, Callable[..., Any]] = {
+    "embed": embed_stego,
+    "extract": extract_payload,
+    "capacity": estimate_capacity_bytes,
+}
+
+class JobQueueFull(Exception):
+    """Admission control refused a job; maps to 503 with Retry-After."""
+    code = 503
+
+    def __init__(self, lane: str, retry_after: int = 5):
+        super().__init__(f"too many pending jobs in the {lane} lane, retry later")
+        self.retry_after = retry_after
+
+def _profiled(fn: Callable[..., Any], kwargs: Dict[str, Any], path: str, tools: frozenset) -> Tuple[Any, Dict[str, Any]]:
+    """Run fn under cProfile / tracemalloc and write the reports next to `path`."""
+    prof = cProfile.Profile() if "cprofile" in tools else None
+    trace = "tracemalloc" in tools
+    if trace:
+        tracemalloc.start()
+    if prof:
+        prof.enable()
+    try:
+        result = fn(**kwargs)
+    finally:
+        if prof:
+            prof.disable()
+        snapshot, peak = None, None
+        if trace:
+            snapshot = tracemalloc.take_snapshot()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    report = io.StringIO()
+    info: Dict[str, Any] = {"files": []}
+    if prof:
+        prof.dump_stats(path + ".prof")
+        info["files"].append(path + ".prof")
+        pstats.Stats(prof, stream=report).sort_stats("cumulative").print_stats(30)
+    if snapshot is not None:
+        info["peak_bytes"] = peak
+        report.write(f"tracemalloc: peak {peak} bytes, top allocations by line\n")
+        for stat in snapshot.statistics("lineno")[:20]:
+            report.write(f"{stat}\n")
+    with open(path + ".txt", "w", encoding="utf-8") as fh:
+        fh.write(report.getvalue())
+    info["files"].append(path + ".txt")
+    return result, info
+
+def _init_worker(processes: int) -> None:
+    """Pool initializer: the plan and PCM caches are per process, so each worker gets its share of the budgets."""
+    share_caches(processes)
+
+def _run(op: str, kwargs: Dict[str, Any], profile_path: Optional[str] = None, profile_tools: frozenset = frozenset()):
+    """
+    Executes in a worker process; returns (result, started_at, finished_at,
+    per-stage timings, profile info or None).
+    """
+    started = time.time()
+    profile = None
+    with api.timings() as t:
+        if profile_path:
+            result, profile = _profiled(OPS[op], kwargs, profile_path, profile_tools)
+        else:
+            result = OPS[op](**kwargs)
+    return result, started, time.time(), t.to_dict(), profile
+
+@dataclass
+class Job:
+    id: str
+    op: str
+    lane: str
+    meta: Dict[str, Any]
+    future: Future
+    submitted_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    size: int = 0
+    timings: Optional[Dict[str, Dict[str, float]]] = None  # per-stage totals from the worker
+    profile: Optional[Dict[str, Any]] = None                # report files of a sampled job
+    files: List[str] = field(default_factory=list)          # spooled inputs/outputs, removed with the job
+
+    @property
+    def state(self) -> str:
+        f = self.future
+        if f.cancelled():
+            return "cancelled"
+        if not f.done():
+            return "running" if f.running() else "queued"
+        return "failed" if f.exception() is not None else "done"
+
+    def status(self) -> Dict[str, Any]:
+        out: Dict[str, Any] = {
+            "job_id": self.id,
+            "op": self.op,
+            "state": self.state,
+            "submitted_at": self.submitted_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+        if out["state"] == "failed":
+            out["error"] = str(self.future.exception())
+        if self.timings is not None:
+            out["timings"] = {name: entry["seconds"] for name, entry in self.timings.items() if entry["seconds"]}
+        if self.profile is not None:
+            out["profile"] = self.profile
+        return out
+
+    @property
+    def queue_seconds(self) -> Optional[float]:
+        return None if self.started_at is None else self.started_at - self.submitted_at
+
+class JobTimeout(Exception):
+    """A synchronous call outlived its timeout; the job is still available under its id."""
+    code = 504
+
+    def __init__(self, job: Job):
+        super().__init__(f"timed out; poll /api/jobs/{job.id}")
+        self.job_id = job.id
+
+class JobManager:
+    """
+    Two bounded process pools: a fast lane for small inputs and a bulk lane for
+    the rest, each with its own admission limit. Pools start on first use (so
+    WSGI servers that fork don't inherit them) with the spawn start method.
+    Job state lives in this process: serve the jobs API from one WSGI process
+    (many threads), the CPU work scales through the pools. Each worker has
+    its own plan and PCM caches, holding 1/N of the budgets (N workers over
+    both lanes); a carrier's next job may land on another worker and miss.
+    """
+    def __init__(
+        self,
+        *,
+        workers: int,
+        fast_workers: int,
+        fast_bytes: int,
+        queue_limit: int,
+        result_ttl: float,
+        profile_rate: float = 0.0,
+        profile_tools: frozenset = frozenset(),
+        profile_dir: str = PROFILE_DIR,
+    ):
+        self.workers = {"fast": max(fast_workers, 1), "bulk": max(workers, 1)}
+        self.fast_bytes = fast_bytes
+        self.queue_limit = queue_limit
+        self.result_ttl = result_ttl
+        self.profile_rate = profile_rate
+        self.profile_tools = profile_tools
+        self.profile_dir = profile_dir
+        self._pools: Dict[str, ProcessPoolExecutor] = {}
+        self._jobs: Dict[str, Job] = {}
+        self._lock = threading.Lock()
+
+    def _pool(self, lane: str) -> ProcessPoolExecutor:
+        pool = self._pools.get(lane)
+        if pool is None:
+            pool = ProcessPoolExecutor(
+                max_workers=self.workers[lane],
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(sum(self.workers.values()),),
+            )
+            self._pools[lane] = pool
+        return pool
+
+    def _expire(self, now: float) -> None:
+        for job_id in [j.id for j in self._jobs.values() if j.finished_at and now - j.finished_at > self.result_ttl]:
+            spool.remove(self._jobs.pop(job_id).files)
+
+    def submit(
+        self,
+        op: str,
+        kwargs: Dict[str, Any],
+        *,
+        size: int,
+        meta: Optional[Dict[str, Any]] = None,
+        files: Sequence[str] = (),
+    ) -> Job:
+        """
+        Queue `op` (a key of OPS) with `kwargs`; `size` is the input size in
+        bytes, used for the lane. The job owns `files` (spooled uploads and
+        output paths in kwargs) and removes them when it is dropped; a job
+        refused by admission control removes them right away.
+        """
+        if op not in OPS:
+            raise ValueError(f"unknown op {op!r}")
+        lane = "fast" if size <= self.fast_bytes else "bulk"
+        job_id = uuid.uuid4().hex
+        args: Tuple[Any, ...] = (op, kwargs)
+        if self.profile_rate > 0 and random.random() < self.profile_rate:
+            args += (os.path.join(self.profile_dir, job_id), self.profile_tools)
+        submitted_at = time.time()
+        with self._lock:
+            self._expire(time.time())
+            pending = sum(1 for j in self._jobs.values() if j.lane == lane and not j.future.done())
+            if pending >= self.queue_limit:
+                spool.remove(files)
+                raise JobQueueFull(lane)
+            try:
+                future = self._pool(lane).submit(_run, *args)
+            except BrokenProcessPool:
+                # a worker died (e.g. OOM-killed): start the lane over
+                self._pools.pop(lane).shutdown(wait=False)
+                future = self._pool(lane).submit(_run, *args)
+            job = Job(id=job_id, op=op, lane=lane, meta=meta or {}, future=future, submitted_at=submitted_at,
+                      size=size, files=list(files))
+            self._jobs[job.id] = job
+        job.future.add_done_callback(lambda f, job=job: self._on_done(job, f))
+        return job
+
+    def _on_done(self, job: Job, future: Future) -> None:
+        job.finished_at = time.time()
+        if not future.cancelled() and future.exception() is None:
+            _result, job.started_at, job.finished_at, job.timings, job.profile = future.result()
+        metrics.observe_job(
+            job.op, job.state,
+            size=job.size,
+            queue_seconds=job.queue_seconds,
+            run_seconds=None if job.started_at is None else job.finished_at - job.started_at,
+            timings=job.timings,
+        )
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            self._expire(time.time())
+            return self._jobs.get(job_id)
+
+    def result(self, job: Job, timeout: Optional[float] = None) -> Any:
+        """The op's return value; re-raises its exception, FutureTimeout if not done in time."""
+        # done callbacks may run after waiters wake up, so fill in the job here too
+        result, job.started_at, job.finished_at, job.timings, job.profile = job.future.result(timeout=timeout)
+        return result
+
+    def run(
+        self,
+        op: str,
+        kwargs: Dict[str, Any],
+        *,
+        size: int,
+        timeout: float,
+        files: Sequence[str] = (),
+    ) -> Tuple[Any, Job]:
+        """
+        Submit and wait: the synchronous endpoints. Returns the result and the
+        finished job (for its timings); `job.files` go back to the caller. On
+        timeout the job keeps running and keeps its files.
+        """
+        job = self.submit(op, kwargs, size=size, files=files)
+        try:
+            result = self.result(job, timeout=timeout)
+        except FutureTimeout:
+            raise JobTimeout(job) from None
+        except BaseException:
+            self.cancel(job.id)
+            raise
+        with self._lock:
+            self._jobs.pop(job.id, None)  # delivered: nothing to keep
+        return result, job
+
+    def cancel(self, job_id: str) -> Optional[bool]:
+        """Cancel a queued job, or drop a finished one; False if it is running, None if unknown."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            if not job.future.done() and not job.future.cancel():
+                return False
+            del self._jobs[job_id]
+        spool.remove(job.files)
+        return True
+
+    def shutdown(self) -> None:
+        for pool in self._pools.values():
+            pool.shutdown(wait=False, cancel_futures=True)
+        self._pools.clear()
+
+jobs = JobManager(
+    workers=JOB_WORKERS,
+    fast_workers=JOB_FAST_WORKERS,
+    fast_bytes=JOB_FAST_BYTES,
+    queue_limit=JOB_QUEUE_LIMIT,
+    result_ttl=JOB_RESULT_TTL,
+    profile_rate=PROFILE_SAMPLE_RATE,
+    profile_tools=PROFILE_TOOLS,
+    profile_dir=PROFILE_DIR,
+)
+atexit.register(jobs.shutdown)
@@ -0,0 +1,205 @@
+# app/services/metrics.py
+from __future__ import annotations
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+import math
+import threading
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+def _labels(**labels: Any) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def _fmt_labels(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    items = list(labels) + ([extra] if extra else [])
+    if not items:
+        return ""
+    escaped = (v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, v in items)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(items, escaped)) + "}"
+
+def _fmt_value(v: float) -> str:
+    if math.isinf(v):
+        return "+Inf" if v > 0 else "-Inf"
+    if isinstance(v, int) or float(v).is_integer():
+        return str(int(v))
+    return repr(float(v))
+
+class _Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self, n_buckets: int):
+        self.counts = [0] * n_buckets
+        self.sum = 0.0
+        self.count = 0
+
+class Metrics:
+    """
+    In-process counters, gauges and histograms, rendered in the Prometheus text
+    exposition format. Everything is fed from the web process: job results
+    carry the stage timings measured in the workers.
+    """
+    def __init__(self, buckets: Iterable[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._help: Dict[str, Tuple[str, str]] = {}
+        self._counters: Dict[str, Dict[Labels, float]] = {}
+        self._gauges: Dict[str, Dict[Labels, float]] = {}
+        self._histograms: Dict[str, Dict[Labels, _Histogram]] = {}
+
+    def _declare(self, name: str, kind: str, help_text: str) -> None:
+        if name not in self._help:
+            self._help[name] = (kind, help_text)
+
+    # ---------- primitives ----------
+
+    def inc(self, name: str, help_text: str, value: float = 1.0, **labels: Any) -> None:
+        with self._lock:
+            self._declare(name, "counter", help_text)
+            series = self._counters.setdefault(name, {})
+            key = _labels(**labels)
+            series[key] = series.get(key, 0.0) + value
+
+    def add_gauge(self, name: str, help_text: str, value: float, **labels: Any) -> None:
+        with self._lock:
+            self._declare(name, "gauge", help_text)
+            series = self._gauges.setdefault(name, {})
+            key = _labels(**labels)
+            series[key] = series.get(key, 0.0) + value
+
+    def observe(self, name: str, help_text: str, value: float, **labels: Any) -> None:
+        with self._lock:
+            self._declare(name, "histogram", help_text)
+            series = self._histograms.setdefault(name, {})
+            key = _labels(**labels)
+            hist = series.get(key)
+            if hist is None:
+                hist = series[key] = _Histogram(len(self.buckets))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    hist.counts[i] += 1
+                    break
+            hist.sum += value
+            hist.count += 1
+
+    # ---------- HTTP requests ----------
+
+    def request_started(self, endpoint: str) -> None:
+        self.add_gauge("mp3lsbsteg_http_requests_in_flight", "HTTP requests being served", 1, endpoint=endpoint)
+
+    def request_finished(self, endpoint: str) -> None:
+        self.add_gauge("mp3lsbsteg_http_requests_in_flight", "HTTP requests being served", -1, endpoint=endpoint)
+
+    def observe_request(self, endpoint: str, method: str, status: int, seconds: float) -> None:
+        self.inc("mp3lsbsteg_http_requests_total", "HTTP requests served",
+                 endpoint=endpoint, method=method, status=status)
+        self.observe("mp3lsbsteg_http_request_seconds", "HTTP request latency",
+                     seconds, endpoint=endpoint, method=method)
+
+    # ---------- pipeline jobs ----------
+
+    def observe_job(
+        self,
+        op: str,
+        state: str,
+        *,
+        size: int,
+        queue_seconds: Optional[float],
+        run_seconds: Optional[float],
+        timings: Optional[Dict[str, Dict[str, float]]],
+    ) -> None:
+        """One finished job: its queue wait, run time and the per-stage totals from the worker."""
+        self.inc("mp3lsbsteg_jobs_total", "Pipeline jobs by final state", op=op, state=state)
+        if queue_seconds is not None:
+            self.observe("mp3lsbsteg_job_queue_seconds", "Time jobs waited for a worker", queue_seconds, op=op)
+        if state != "done" or run_seconds is None:
+            return
+        self.observe("mp3lsbsteg_job_run_seconds", "Time jobs ran in a worker", run_seconds, op=op)
+        self.inc("mp3lsbsteg_bytes_processed_total", "Input bytes of completed jobs", size, op=op)
+        self.inc("mp3lsbsteg_job_run_seconds_total", "Worker time of completed jobs", run_seconds, op=op)
+
+        for stage_name, entry in (timings or {}).items():
+            if "hit" in entry or "miss" in entry:
+                for result in ("hit", "miss"):
+                    if entry.get(result):
+                        self.inc("mp3lsbsteg_cache_lookups_total", "Cache lookups by result",
+                                 entry[result], cache=stage_name, result=result)
+                continue
+            self.observe("mp3lsbsteg_stage_seconds", "Time per pipeline stage per job",
+                         entry["seconds"], op=op, stage=stage_name)
+            if stage_name == "frame_index":
+                self.inc("mp3lsbsteg_frames_processed_total", "MP3 frames parsed", entry.get("frames", 0), op=op)
+
+    # ---------- exposition ----------
+
+    def _derived(self) -> List[Tuple[str, str, str, Dict[Labels, float]]]:
+        """Gauges computed from the counters at scrape time."""
+        frames = self._counters.get("mp3lsbsteg_frames_processed_total", {})
+        run = self._counters.get("mp3lsbsteg_job_run_seconds_total", {})
+        fps = {labels: frames[labels] / run[labels] for labels in frames if run.get(labels)}
+
+        lookups = self._counters.get("mp3lsbsteg_cache_lookups_total", {})
+        hits: Dict[Labels, float] = {}
+        totals: Dict[Labels, float] = {}
+        for labels, v in lookups.items():
+            cache = tuple(kv for kv in labels if kv[0] == "cache")
+            totals[cache] = totals.get(cache, 0.0) + v
+            if ("result", "hit") in labels:
+                hits[cache] = hits.get(cache, 0.0) + v
+        ratio = {cache: hits.get(cache, 0.0) / total for cache, total in totals.items() if total}
+
+        return [
+            ("mp3lsbsteg_frames_per_second", "gauge", "Frames parsed per second of worker time", fps),
+            ("mp3lsbsteg_cache_hit_ratio", "gauge", "Cache hits over lookups", ratio),
+        ]
+
+    def render(self) -> str:
+        lines: List[str] = []
+        with self._lock:
+            for name in sorted(self._help):
+                kind, help_text = self._help[name]
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                if kind == "histogram":
+                    for labels, hist in sorted(self._histograms[name].items()):
+                        cumulative = 0
+                        for bound, n in zip(self.buckets, hist.counts):
+                            cumulative += n
+                            lines.append(f"{name}_bucket{_fmt_labels(labels, ('le', _fmt_value(bound)))} {cumulative}")
+                        lines.append(f"{name}_bucket{_fmt_labels(labels, ('le', '+Inf'))} {hist.count}")
+                        lines.append(f"{name}_sum{_fmt_labels(labels)} {_fmt_value(hist.sum)}")
+                        lines.append(f"{name}_count{_fmt_labels(labels)} {hist.count}")
+                else:
+                    series = (self._counters if kind == "counter" else self._gauges)[name]
+                    for labels, v in sorted(series.items()):
+                        lines.append(f"{name}{_fmt_labels(labels)} {_fmt_value(v)}")
+            for name, kind, help_text, series in self._derived():
+                if not series:
+                    continue
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, v in sorted(series.items()):
+                    lines.append(f"{name}{_fmt_labels(labels)} {_fmt_value(v)}")
+        return "\n".join(lines) + "\n"
+
+def server_timing(
+    timings: Optional[Dict[str, Dict[str, float]]],
+    *,
+    queue_seconds: Optional[float] = None,
+    total_seconds: Optional[float] = None,
+) -> str:
+    """Server-Timing header value: each stage in ms, cache lookups as hit/miss, then queue and total."""
+    parts: List[str] = []
+    for stage_name, entry in (timings or {}).items():
+        if "hit" in entry or "miss" in entry:
+            parts.append(f'{stage_name};desc="{int(entry.get("hit", 0))} hit, {int(entry.get("miss", 0))} miss"')
+        else:
+            parts.append(f"{stage_name};dur={entry['seconds'] * 1e3:.2f}")
+    if queue_seconds is not None:
+        parts.append(f"queue;dur={max(queue_seconds, 0.0) * 1e3:.2f}")
+    if total_seconds is not None:
+        parts.append(f"total;dur={total_seconds * 1e3:.2f}")
+    return ", ".join(parts)
+
+metrics = Metrics()
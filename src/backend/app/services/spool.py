@@ -0,0 +1,108 @@
+# app/services/spool.py
+# Request bodies and results kept on disk instead of in memory. Uploads of a
+# request larger than UPLOAD_SPOOL_BYTES are written by the multipart parser
+# straight into named files here, workers memory-map them by path and write
+# their output next to them, and the response streams that file back. Every
+# file belongs to the request that made it (removed at teardown) until a job
+# or a streamed response takes it over.
+from __future__ import annotations
+from flask import Flask, Request, request
+from typing import IO, List, Optional, Sequence, Tuple, Union
+from werkzeug.datastructures import FileStorage
+import io
+import os
+import tempfile
+
+# Requests above this size (bytes) spool their uploads to files, default 1 MB
+UPLOAD_SPOOL_BYTES = int(os.getenv("UPLOAD_SPOOL_BYTES") or 1024 * 1024)
+# Where spooled uploads and results live while a request or job uses them
+SPOOL_DIR = os.getenv("SPOOL_DIR") or os.path.join(tempfile.gettempdir(), "mp3lsbsteg-spool")
+
+# An upload handed to the services: its path when spooled, else its bytes
+Source = Union[str, bytes]
+
+class SpoolingRequest(Request):
+    """Request whose big multipart uploads land in named files under SPOOL_DIR."""
+    def _get_file_stream(
+        self,
+        total_content_length: Optional[int],
+        content_type: Optional[str],
+        filename: Optional[str] = None,
+        content_length: Optional[int] = None,
+    ) -> IO[bytes]:
+        if total_content_length is not None and total_content_length <= UPLOAD_SPOOL_BYTES:
+            return io.BytesIO()
+        os.makedirs(SPOOL_DIR, exist_ok=True)
+        fh = tempfile.NamedTemporaryFile("w+b", dir=SPOOL_DIR, prefix="upload-", delete=False)
+        _request_files(self).append(fh.name)
+        return fh
+
+def _request_files(req: Request) -> List[str]:
+    files = req.environ.get("mp3lsbsteg.spool")
+    if files is None:
+        files = req.environ["mp3lsbsteg.spool"] = []
+    return files
+
+def remove(paths: Sequence[str]) -> None:
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass  # already gone, or still open elsewhere (Windows)
+
+def new_file(prefix: str, suffix: str = "") -> str:
+    """An empty file in SPOOL_DIR, owned by the current request."""
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    fd, path = tempfile.mkstemp(prefix=prefix, suffix=suffix, dir=SPOOL_DIR)
+    os.close(fd)
+    _request_files(request).append(path)
+    return path
+
+def source(upload: FileStorage) -> Tuple[Source, int]:
+    """(path or bytes, size) of a form upload; a spooled one is never read into memory."""
+    path = getattr(upload.stream, "name", None)
+    if isinstance(path, str) and path in _request_files(request):
+        upload.stream.flush()
+        return path, os.path.getsize(path)
+    data = upload.read()
+    return data, len(data)
+
+class _RemovedOnClose(io.FileIO):
+    """A result file being streamed: removed once the server is done with it."""
+    def close(self) -> None:
+        if not self.closed:
+            super().close()
+            remove([self.name])
+
+def open_result(path: str) -> IO[bytes]:
+    """
+    Open a spooled result for streaming. If the current request owns it, the
+    file moves to the response: removed when the server closes the body, not
+    at teardown while it is still being sent.
+    """
+    files = _request_files(request)
+    if path in files:
+        files.remove(path)
+        return _RemovedOnClose(path)
+    return open(path, "rb")
+
+def detach() -> List[str]:
+    """Hand the current request's files over (to a job); the request stops removing them."""
+    files = _request_files(request)
+    taken, files[:] = list(files), []
+    return taken
+
+def attach(paths: Sequence[str]) -> None:
+    """Make the current request own `paths` again: removed at teardown."""
+    _request_files(request).extend(paths)
+
+def init_app(app: Flask) -> None:
+    app.request_class = SpoolingRequest
+
+    @app.teardown_request
+    def _remove_spooled(_exc):
+        files = _request_files(request)
+        if files:
+            request.close()  # the upload streams; Windows won't remove open files
+            remove(files)
+            files[:] = []
@@ -1,16 +1,86 @@
 # app/services/steg_service.py
 from __future__ import annotations
-from typing import Optional, Tuple
+from typing import Iterator, Optional, Tuple, Union
+from collections import OrderedDict
+from contextlib import contextmanager
 from mp3lsbsteg import api
+from mp3lsbsteg.io.carrier import open_carrier
 from mp3lsbsteg.stego.payload import HEADER_SIZE  
-import io
 import math
+import os
+import threading
+
+from .spool import Source
 
 # Hardcoded selection settings
 FRACTION = 1.0
 MASK_PCTL = 0.75
 MAX_FRAMES = None  
 
+# Budget for cached embed plans (bytes of position arrays), default 64 MB
+PLAN_CACHE_BYTES = int(os.getenv("PLAN_CACHE_BYTES") or 64 * 1024 * 1024)
+# Budget for decoded carrier PCM used by the PSNR metric, default 256 MB
+PCM_CACHE_BYTES = int(os.getenv("PCM_CACHE_BYTES") or 256 * 1024 * 1024)
+# Both caches live in each process that runs the ops: the job pools call
+# share_caches() so the budgets above are totals over all their workers.
+
+class _PlanCache:
+    """
+    LRU of api.EmbedPlan keyed by (carrier digest, selection settings), evicted
+    by the total size of the position arrays. Lets /capacity followed by /embed
+    on the same carrier run the position selection only once.
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[tuple, api.EmbedPlan]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, carrier_bytes, *, bits_per_frame: int, key: Optional[str]) -> api.EmbedPlan:
+        """carrier_bytes: any buffer (bytes, or a memory-mapped carrier)."""
+        digest = api.carrier_digest(carrier_bytes)
+        cache_key = (digest, bits_per_frame, FRACTION, key, MASK_PCTL, MAX_FRAMES)
+        with self._lock:
+            plan = self._entries.get(cache_key)
+            if plan is not None:
+                self._entries.move_to_end(cache_key)
+        if plan is not None:
+            api.record("plan_cache", hit=1)
+            return plan
+
+        api.record("plan_cache", miss=1)
+        plan = api.plan(
+            carrier_bytes,
+            bits_per_frame=bits_per_frame,
+            fraction=FRACTION,
+            key=key,
+            mask_percentile=MASK_PCTL,
+            max_frames=MAX_FRAMES,
+        )
+        if plan.nbytes > self.max_bytes:
+            return plan
+        with self._lock:
+            if cache_key not in self._entries:
+                self._entries[cache_key] = plan
+                self._bytes += plan.nbytes
+            while self._bytes > self.max_bytes:
+                _, old = self._entries.popitem(last=False)
+                self._bytes -= old.nbytes
+        return plan
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+_plans = _PlanCache(PLAN_CACHE_BYTES)
+_carrier_pcm = api.PcmCache(PCM_CACHE_BYTES)
+
+def share_caches(processes: int) -> None:
+    """Shrink this process's caches to its share when `processes` processes each hold their own."""
+    _plans.max_bytes = PLAN_CACHE_BYTES // max(processes, 1)
+    _carrier_pcm.max_bytes = PCM_CACHE_BYTES // max(processes, 1)
+
 def _parse_bpf(raw: Optional[str], default: int = 4) -> int:
     try:
         bpf = int(raw) if raw is not None else default
@@ -26,19 +96,45 @@ def _parse_bool(raw: Optional[str], default: bool = False) -> bool:
     s = str(raw).strip().lower()
     return s in {"1", "true", "t", "yes", "y", "on"}
 
+@contextmanager
+def _buffer(src: Source) -> Iterator:
+    """The source as a buffer: a read-only memory map for a path, the bytes themselves otherwise."""
+    if isinstance(src, str):
+        with open_carrier(src) as mm:
+            yield mm
+    else:
+        yield src
+
+def _read(src: Source) -> bytes:
+    if isinstance(src, str):
+        with open(src, "rb") as fh:
+            return fh.read()
+    return src
+
+def _psnr(before, after) -> float:
+    # PSNR after decode (mono single score); only the frames the embed touched are decoded
+    psnr_db = api.psnr(
+        before, after, samplerate=48000, mono=True, align="min",
+        differential=True, cache=_carrier_pcm,
+    )
+    return psnr_db if math.isfinite(psnr_db) else float("inf")
+
 def embed_stego(
     *,
-    carrier_bytes: bytes,
-    payload_bytes: bytes,
+    carrier: Source,
+    payload: Source,
     payload_filename: Optional[str],
     bits_per_frame: int,
     key: Optional[str],
     vigenere: bool,
-) -> Tuple[bytes, float]:
-    """Return (stego_mp3_bytes, psnr_db)."""
-    stego = api.embed_bytes(
-        carrier_bytes,
-        payload_bytes,
+    out_path: Optional[str] = None,
+) -> Tuple[Union[bytes, str], float]:
+    """
+    Return (stego_mp3, psnr_db). A carrier given as bytes gives the stego bytes;
+    a spooled carrier (path) is copied to `out_path` and patched there through
+    a memory map, and `out_path` is returned: it is never read into memory.
+    """
+    settings = dict(
         payload_filename=payload_filename,
         bits_per_frame=bits_per_frame,
         fraction=FRACTION,
@@ -47,22 +143,29 @@ def embed_stego(
         mask_percentile=MASK_PCTL,
         max_frames=MAX_FRAMES,
     )
-    # PSNR after decode (mono single score)
-    psnr_db = api.psnr(carrier_bytes, stego, samplerate=48000, mono=True, align="min")
-    if not math.isfinite(psnr_db):
-        psnr_db = float("inf")
-    return stego, psnr_db
+    payload_bytes = _read(payload)
+    if not isinstance(carrier, str):
+        plan = _plans.get(carrier, bits_per_frame=bits_per_frame, key=key or None)
+        stego = api.embed_bytes(carrier, payload_bytes, plan=plan, **settings)
+        return stego, _psnr(carrier, stego)
+
+    if out_path is None:
+        raise ValueError("out_path is required for a spooled carrier")
+    with _buffer(carrier) as carrier_buf:
+        plan = _plans.get(carrier_buf, bits_per_frame=bits_per_frame, key=key or None)
+    api.embed_file(carrier, out_path, payload_bytes, plan=plan, **settings)
+    with _buffer(carrier) as before, _buffer(out_path) as after:
+        return out_path, _psnr(before, after)
 
 def extract_payload(
     *,
-    stego_bytes: bytes,
+    stego: Source,
     bits_per_frame: int,
     key: Optional[str],
     vigenere: bool,
 ) -> Tuple[bytes, str]:
-    """Return (payload_bytes, ext)."""
-    data, ext = api.extract_auto_bytes(
-        stego_bytes,
+    """Return (payload_bytes, ext). A spooled stego file is read through a memory map."""
+    settings = dict(
         bits_per_frame=bits_per_frame,
         fraction=FRACTION,
         key=key or None,
@@ -70,20 +173,20 @@ def extract_payload(
         max_frames=MAX_FRAMES,
         vigenere=vigenere,
     )
+    if isinstance(stego, str):
+        data, ext = api.extract_auto_file(stego, **settings)
+    else:
+        data, ext = api.extract_auto_bytes(stego, **settings)
     return data, ext or ""
 
-def estimate_capacity_bytes(*, carrier_bytes: bytes, bits_per_frame: int) -> dict:
+def estimate_capacity_bytes(*, carrier: Source, bits_per_frame: int, key: Optional[str] = None) -> dict:
     """
     Returns capacity metrics for the given carrier and settings.
     fraction=1.0, mask_percentile=0.90, max_frames=None are hardcoded.
+    The plan is cached, so passing the same key as the following embed lets it reuse the work.
     """
-    cap_bits = api.estimate_capacity(
-        carrier_bytes,
-        bits_per_frame=bits_per_frame,
-        fraction=FRACTION,
-        mask_percentile=MASK_PCTL,
-        max_frames=MAX_FRAMES,
-    )
+    with _buffer(carrier) as carrier_buf:
+        cap_bits = len(_plans.get(carrier_buf, bits_per_frame=bits_per_frame, key=key or None))
     cap_bytes = cap_bits // 8
     header_bytes = HEADER_SIZE  # 16
     usable_payload_bytes = max(cap_bytes - header_bytes, 0)
@@ -11,4 +11,8 @@ if [ -d "/vendor/mp3lsbstego" ]; then
   pip install --no-cache-dir /vendor/mp3lsbstego
 fi
 
-exec flask run --host=0.0.0.0 --port=8080
+if [ "${FLASK_DEBUG:-0}" = "1" ]; then
+  # dev server with reload
+  exec flask run --host=0.0.0.0 --port=8080
+fi
+exec gunicorn -c gunicorn.conf.py app.wsgi:app
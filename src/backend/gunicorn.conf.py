@@ -0,0 +1,15 @@
+# gunicorn.conf.py
+# Production server: gunicorn -c gunicorn.conf.py app.wsgi:app
+# CPU work runs in the process pools of app/services/jobs.py, so the web side
+# only needs threads to wait on them. Job state lives in the web process: keep
+# WEB_CONCURRENCY=1 unless a load balancer pins /api/jobs/<id> to one process.
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT') or '8080'}"
+workers = int(os.getenv("WEB_CONCURRENCY") or 1)
+worker_class = "gthread"
+threads = int(os.getenv("WEB_THREADS") or 32)
+# longer than SYNC_TIMEOUT, so a slow sync call answers 504 itself
+timeout = int(os.getenv("WEB_TIMEOUT") or 180)
+graceful_timeout = 30
+accesslog = "-"
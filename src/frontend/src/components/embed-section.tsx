@@ -45,6 +45,7 @@ export function EmbedSection({
         carrier: audioFile,
         bitsPerFrame,
         vigenere: useEncryption, // echoed back; does not affect capacity
+        key: stegoKey,
         payloadSize: secretFile ? secretFile.size : undefined,
       })
 
@@ -72,11 +72,15 @@ export async function capacityApi(params: {
   bitsPerFrame: number;
   payloadSize?: number;   // optional
   vigenere: boolean;      // echoed back by server (doesn't affect capacity)
+  key?: string;           // optional; lets the following embed reuse the server-side plan
 }) {
   const fd = new FormData();
   fd.append("carrier", params.carrier);
   fd.append("bits_per_frame", String(params.bitsPerFrame));
   fd.append("vigenere", String(params.vigenere));
+  if (params.key) {
+    fd.append("key", params.key);
+  }
   if (typeof params.payloadSize === "number") {
     fd.append("payload_size", String(params.payloadSize));
   }